@@ -271,7 +271,7 @@ class SvgConverter:
             bg_img = self.image_converter.convert(page_number, visibility_overlay=vo_only_bg)
             buffer = BytesIO()
             bg_img.save(buffer, format='png')
-            bg_b64str = base64.b64encode(buffer.getvalue()).decode('ascii')
+            bg_b64str = base64.b64encode(buffer.getbuffer()).decode('ascii')
             dwg.add(dwg.image('data:image/png;base64,' + bg_b64str, insert=(0, 0), size=(page_width, page_height)))
 
         vo_except_bg = build_visibility_overlay(background=VisibilityOverlay.INVISIBLE)
@@ -294,20 +294,22 @@ class SvgConverter:
             # iterate over path curves
             if len(path) > 0:
                 svgpath = dwg.path(fill=color.web_string(user_color, mode=self.palette.mode))
+                push = svgpath.push
                 for curve in path:
                     start = curve.start_point
-                    svgpath.push("M", start.x, start.y)
+                    push("M", start.x, start.y)
                     for segment in curve:
                         end = segment.end_point
+                        ex, ey = end.x, end.y
                         if segment.is_corner:
                             c = segment.c
-                            svgpath.push("L", c.x, c.y)
-                            svgpath.push("L", end.x, end.y)
+                            push("L", c.x, c.y)
+                            push("L", ex, ey)
                         else:
                             c1 = segment.c1
                             c2 = segment.c2
-                            svgpath.push("C", c1.x, c1.y, c2.x, c2.y, end.x, end.y)
-                    svgpath.push("Z")
+                            push("C", c1.x, c1.y, c2.x, c2.y, ex, ey)
+                    push("Z")
                 dwg.add(svgpath)
         return dwg.tostring()
 
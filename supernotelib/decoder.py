@@ -15,21 +15,49 @@
 """Decoder classes."""
 
 import base64
+import concurrent.futures
 import json
 import numpy as np
 import png
-import queue
-import zlib
+
+try:
+    # isal is a faster drop-in replacement of zlib
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 from . import color
 from . import exceptions
 
 
+_color_lut_cache = {}
+
+
 class BaseDecoder:
     """Abstract decoder class."""
     def decode(self, data, palette=None, all_blank=False, horizontal=False):
         raise NotImplementedError('subclasses must implement decode method')
 
+    def decode_many(self, data_list, *args, max_workers=None, **kwargs):
+        """Decodes multiple data concurrently on a thread pool.
+
+        Parameters
+        ----------
+        data_list : list of bytes
+            list of data to be decoded
+        max_workers : int
+            optional maximum number of threads
+        *args, **kwargs
+            passed to decode method
+
+        Returns
+        -------
+        list
+            list of decoded results in the same order as data_list
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda data: self.decode(data, *args, **kwargs), data_list))
+
 
 class FlateDecoder(BaseDecoder):
     """Decoder for SN_ASA_COMPRESS protocol."""
@@ -62,11 +90,12 @@ class FlateDecoder(BaseDecoder):
         int
             bit per pixel
         """
-        uncompressed = zlib.decompress(data)
+        # uncompressed size is known, so allocate output buffer at once
+        uncompressed = zlib.decompress(data, bufsize=self.INTERNAL_PAGE_WIDTH * self.INTERNAL_PAGE_HEIGHT * 2)
         bitmap = np.frombuffer(uncompressed, dtype=np.uint16)
         bitmap = np.reshape(bitmap, (self.INTERNAL_PAGE_WIDTH, self.INTERNAL_PAGE_HEIGHT))
-        bitmap = np.rot90(bitmap, -1) # rotate 90 degrees clockwise
-        bitmap = np.delete(bitmap, slice(-16, None), axis=0) # delete bottom 16 lines
+        # delete bottom 16 lines and rotate 90 degrees clockwise, then copy only once
+        bitmap = np.ascontiguousarray(bitmap[:, :-16].T[:, ::-1])
 
         # change colors
         if palette is None:
@@ -133,64 +162,84 @@ class RattaRleDecoder(BaseDecoder):
         else:
             bit_per_pixel = 8
 
-        colormap = self._create_colormap(palette)
-
         if horizontal:
             page_height, page_width = (page_width, page_height) # swap width and height
 
         expected_length = page_height * page_width * int(bit_per_pixel / 8)
 
-        uncompressed = bytearray()
+        colorcodes, lengths = self._extract_runs(data, page_height * page_width, all_blank)
+
+        # check the length before expanding runs so that the output buffer is allocated only once
+        uncompressed_length = int(lengths.sum()) * int(bit_per_pixel / 8)
+        if uncompressed_length != expected_length:
+            raise exceptions.DecoderException(f'uncompressed bitmap length = {uncompressed_length}, expected = {expected_length}')
+
+        color_lut = self._get_color_lut(palette)
+        if len(colorcodes) > 0 and (colorcodes == colorcodes[0]).all():
+            # blank layer is filled with a single color, so we don't need to expand runs
+            uncompressed = color_lut[colorcodes[0]].tobytes() * (page_height * page_width)
+        else:
+            uncompressed = np.repeat(color_lut[colorcodes], lengths, axis=0).tobytes()
+
+        return uncompressed, (page_width, page_height), bit_per_pixel
+
+    def _extract_runs(self, data, total_pixels, all_blank=False):
+        """Returns color codes and lengths of runs in the compressed data.
+
+        Parameters
+        ----------
+        data : bytes
+            compressed bitmap data
+        total_pixels : int
+            number of pixels in the bitmap
+        all_blank : bool
+            true if the bitmap is blank
+
+        Returns
+        -------
+        numpy.ndarray
+            color code of each run
+        numpy.ndarray
+            length of each run
+        """
+        colorcodes = []
+        lengths = []
+        # bind to locals because this loop runs for every run in the bitmap
+        push_colorcode = colorcodes.append
+        push_length = lengths.append
+        special_length_marker = self.SPECIAL_LENGTH_MARKER
+        special_length = self.SPECIAL_LENGTH_FOR_BLANK if all_blank else self.SPECIAL_LENGTH
+        holded = False
+        holded_colorcode = holded_length = 0
         bin = iter(data)
-        try:
-            holder = ()
-            waiting = queue.Queue()
-            while True:
-                colorcode = next(bin)
-                length = next(bin)
-                data_pushed = False
-
-                if len(holder) > 0:
-                    (prev_colorcode, prev_length) = holder
-                    holder = ()
-                    if colorcode == prev_colorcode:
-                        length = 1 + length + (((prev_length & 0x7f) + 1) << 7)
-                        waiting.put((colorcode, length))
-                        data_pushed = True
-                    else:
-                        prev_length = ((prev_length & 0x7f) + 1) << 7
-                        waiting.put((prev_colorcode, prev_length))
-
-                if not data_pushed:
-                    if length == self.SPECIAL_LENGTH_MARKER:
-                        if all_blank:
-                            length = self.SPECIAL_LENGTH_FOR_BLANK
-                        else:
-                            length = self.SPECIAL_LENGTH
-                        waiting.put((colorcode, length))
-                        data_pushed = True
-                    elif length & 0x80 != 0:
-                        holder = (colorcode, length)
-                        # holded data are processed at next loop
-                    else:
-                        length += 1
-                        waiting.put((colorcode, length))
-                        data_pushed = True
-
-                while not waiting.empty():
-                    (colorcode, length) = waiting.get()
-                    uncompressed += self._create_color_bytearray(palette.mode, colormap, colorcode, length)
-        except StopIteration:
-            if len(holder) > 0:
-                (colorcode, length) = holder
-                length = self._adjust_tail_length(length, len(uncompressed), expected_length)
-                if length > 0:
-                    uncompressed += self._create_color_bytearray(palette.mode, colormap, colorcode, length)
-
-        if len(uncompressed) != expected_length:
-            raise exceptions.DecoderException(f'uncompressed bitmap length = {len(uncompressed)}, expected = {expected_length}')
-
-        return bytes(uncompressed), (page_width, page_height), bit_per_pixel
+        for colorcode, length in zip(bin, bin):
+            if holded:
+                holded = False
+                if colorcode == holded_colorcode:
+                    push_colorcode(colorcode)
+                    push_length(1 + length + (((holded_length & 0x7f) + 1) << 7))
+                    continue
+                push_colorcode(holded_colorcode)
+                push_length(((holded_length & 0x7f) + 1) << 7)
+
+            if length == special_length_marker:
+                push_colorcode(colorcode)
+                push_length(special_length)
+            elif length & 0x80:
+                holded = True
+                holded_colorcode, holded_length = colorcode, length
+                # holded data are processed at next loop
+            else:
+                push_colorcode(colorcode)
+                push_length(length + 1)
+
+        if holded:
+            length = self._adjust_tail_length(holded_length, sum(lengths), total_pixels)
+            if length > 0:
+                colorcodes.append(holded_colorcode)
+                lengths.append(length)
+
+        return np.array(colorcodes, dtype=np.uint8), np.array(lengths, dtype=np.intp)
 
     def _create_colormap(self, palette):
         colormap = {
@@ -205,14 +254,28 @@ class RattaRleDecoder(BaseDecoder):
         }
         return colormap
 
-    def _create_color_bytearray(self, mode, colormap, color_code, length):
-        if mode == color.MODE_RGB:
-            c = colormap.get(color_code)
-            r, g, b = color.get_rgb(c)
-            return bytearray((r, g, b,)) * length
+    def _get_color_lut(self, palette):
+        # decoders are created for each layer, so color tables are shared among instances
+        key = (type(self), palette.mode, palette.black, palette.darkgray, palette.gray, palette.white,
+               palette.transparent, palette.darkgray_compat, palette.gray_compat)
+        lut = _color_lut_cache.get(key)
+        if lut is None:
+            lut = self._create_color_lut(palette)
+            lut.flags.writeable = False
+            _color_lut_cache[key] = lut
+        return lut
+
+    def _create_color_lut(self, palette):
+        colormap = self._create_colormap(palette)
+        if palette.mode == color.MODE_RGB:
+            lut = np.zeros((256, 3), dtype=np.uint8)
+            for color_code, c in colormap.items():
+                lut[color_code] = color.get_rgb(c)
         else:
-            c = colormap.get(color_code)
-            return bytearray((c,)) * length
+            lut = np.zeros(256, dtype=np.uint8)
+            for color_code, c in colormap.items():
+                lut[color_code] = c
+        return lut
 
     def _adjust_tail_length(self, tail_length, current_length, total_length):
         gap = total_length - current_length
@@ -249,20 +312,14 @@ class RattaRleX2Decoder(RattaRleDecoder):
         }
         return colormap
 
-    def _create_color_bytearray(self, mode, colormap, color_code, length):
-        if mode == color.MODE_RGB:
-            c = colormap.get(color_code)
-            if c is not None:
-                r, g, b = color.get_rgb(c)
-            else: # if the color_code is not included in colormap, use the value as color directly
-                r, g, b = (color_code, color_code, color_code)
-            return bytearray((r, g, b,)) * length
-        else:
-            c = colormap.get(color_code)
-            if c is None:
-                c = color_code
-            return bytearray((c,)) * length
-
+    def _create_color_lut(self, palette):
+        lut = super()._create_color_lut(palette)
+        # if the color code is not included in colormap, use the value as color directly
+        unknown = np.ones(256, dtype=bool)
+        unknown[list(self._create_colormap(palette).keys())] = False
+        color_codes = np.arange(256, dtype=np.uint8)[unknown]
+        lut[unknown] = color_codes[:, np.newaxis] if lut.ndim == 2 else color_codes
+        return lut
 
 class PngDecoder(BaseDecoder):
     """Decoder for PNG."""
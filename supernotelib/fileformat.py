@@ -146,25 +146,11 @@ class Notebook:
         self.type = metadata.type
         self.signature = metadata.signature
         self.cover = Cover()
-        self.keywords = []
-        has_keywords = metadata.footer.get(KEY_KEYWORDS) is not None
-        if has_keywords:
-            for k in metadata.footer.get(KEY_KEYWORDS):
-                self.keywords.append(Keyword(k))
-        self.titles = []
-        has_titles = metadata.footer.get(KEY_TITLES) is not None
-        if has_titles:
-            for t in metadata.footer.get(KEY_TITLES):
-                self.titles.append(Title(t))
-        self.links = []
-        has_links = metadata.footer.get(KEY_LINKS) is not None
-        if has_links:
-            for l in metadata.footer.get(KEY_LINKS):
-                self.links.append(Link(l))
-        self.pages = []
-        total = metadata.get_total_pages()
-        for i in range(total):
-            self.pages.append(Page(metadata.pages[i]))
+        footer = metadata.footer
+        self.keywords = [Keyword(k) for k in footer.get(KEY_KEYWORDS) or []]
+        self.titles = [Title(t) for t in footer.get(KEY_TITLES) or []]
+        self.links = [Link(l) for l in footer.get(KEY_LINKS) or []]
+        self.pages = [Page(p) for p in metadata.pages]
 
     def get_metadata(self):
         return self.metadata
@@ -211,6 +197,8 @@ class Notebook:
         return int(self.signature[-8:]) >= 20230015
 
 class Cover:
+    __slots__ = ('content',)
+
     def __init__(self):
         self.content = None
 
@@ -221,6 +209,8 @@ class Cover:
         return self.content
 
 class Keyword:
+    __slots__ = ('metadata', 'content', 'page_number', 'position')
+
     def __init__(self, keyword_info):
         self.metadata = keyword_info
         self.content = None
@@ -247,6 +237,8 @@ class Keyword:
         return (int(left), int(top), int(left) + int(width), int(top) + int(height))
 
 class Title:
+    __slots__ = ('metadata', 'content', 'page_number', 'position')
+
     def __init__(self, title_info):
         self.metadata = title_info
         self.content = None
@@ -276,6 +268,8 @@ class Link:
     DIRECTION_OUT = 0
     DIRECTION_IN = 1
 
+    __slots__ = ('metadata', 'content', 'page_number')
+
     def __init__(self, link_info):
         self.metadata = link_info
         self.content = None
@@ -326,17 +320,24 @@ class Page:
     ORIENTATION_VERTICAL = "1000"
     ORIENTATION_HORIZONTAL = "1090"
 
+    __slots__ = ('metadata', 'content', 'totalpath', 'recogn_file', 'recogn_text', '_layers')
+
     def __init__(self, page_info):
         self.metadata = page_info
         self.content = None
         self.totalpath = None
         self.recogn_file = None
         self.recogn_text = None
-        self.layers = []
-        layer_supported = page_info.get(KEY_LAYERS) is not None
-        if layer_supported:
-            for i in range(5):
-                self.layers.append(Layer(self.metadata[KEY_LAYERS][i]))
+        self._layers = None # layers are created on first access
+
+    @property
+    def layers(self):
+        if self._layers is None:
+            if self.is_layer_supported():
+                self._layers = [Layer(self.metadata[KEY_LAYERS][i]) for i in range(5)]
+            else:
+                self._layers = []
+        return self._layers
 
     def set_content(self, content):
         self.content = content
@@ -420,6 +421,8 @@ class Page:
         return self.metadata.get('ORIENTATION', self.ORIENTATION_VERTICAL)
 
 class Layer:
+    __slots__ = ('metadata', 'content')
+
     def __init__(self, layer_info):
         self.metadata = layer_info
         self.content = None
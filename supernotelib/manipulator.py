@@ -15,67 +15,79 @@
 """Note manipulator classes."""
 
 import io
+import itertools
 import os
-import re
+import struct
 
 from . import exceptions
-from . import fileformat
 from . import parser
 from . import utils
 
+_UINT32 = struct.Struct('<I') # length and address fields
+
 class NotebookBuilder:
     def __init__(self, offset=0):
-        self.total_size = offset
-        self.toc = {}
-        self.blocks = []
+        self.offset = offset
+        self.toc = {} # label -> list of block addresses
+        self.buffer = bytearray()
+        # labels referred from footer, classified when they are appended
+        self.keyword_metadata_labels = []
+        self.title_metadata_labels = []
+        self.style_labels = []
+        self.page_metadata_labels = []
 
     def get_total_size(self):
-        return self.total_size
+        return self.offset + len(self.buffer)
 
     def get_block_address(self, label):
-        if type(self.toc.get(label)) == list:
-            address = self.toc.get(label)[0] # use first one
-        else:
-            address = self.toc.get(label)
-        return address if address is not None else 0
+        return self.toc.get(label, (0,))[0] # use first one
 
     def get_duplicate_block_address_list(self, label):
-        if type(self.toc.get(label)) == list:
-            return self.toc.get(label)
-        else:
-            return [self.toc.get(label)]
+        return self.toc.get(label, [None])
 
     def get_labels(self):
         return self.toc.keys()
 
     def append(self, label, block, skip_block_size=False, allow_duplicate=False):
+        """Appends a block and returns its address, or None if the label is rejected as duplicate."""
         if not label or block is None:
             raise ValueError('empty label or block is not allowed')
         label_duplicated = label in self.toc
         if label_duplicated and not allow_duplicate:
-            return False
-        block_size = len(block)
+            return None
+        address = self.get_total_size()
         if not skip_block_size:
-            self.blocks.append(block_size.to_bytes(fileformat.LENGTH_FIELD_SIZE, 'little'))
-        self.blocks.append(block)
+            self.buffer += _UINT32.pack(len(block))
+        self.buffer += block
         if label_duplicated:
-            if type(self.toc[label]) == list:
-                self.toc[label].append(self.total_size)
-            else:
-                self.toc[label] = [self.toc[label], self.total_size]
+            self.toc[label].append(address)
         else:
-            self.toc.setdefault(label, self.total_size)
-        self.total_size += block_size
-        if not skip_block_size:
-            self.total_size += fileformat.LENGTH_FIELD_SIZE
-        return True
+            self.toc[label] = [address]
+            self._classify_label(label)
+        return address
 
     def build(self):
-        return b''.join(self.blocks)
+        return bytes(self.buffer)
+
+    def build_into(self, fobj):
+        """Writes the built binary to a file object without copying it."""
+        fobj.write(memoryview(self.buffer))
+
+    def _classify_label(self, label):
+        if label.startswith('STYLE_'):
+            self.style_labels.append(label)
+        elif not label.endswith('/metadata'):
+            return
+        elif label.startswith('KEYWORD_') and _is_numbered_label(label, 'KEYWORD_', 8):
+            self.keyword_metadata_labels.append(label)
+        elif label.startswith('TITLE_') and _is_numbered_label(label, 'TITLE_', 8):
+            self.title_metadata_labels.append(label)
+        elif label.startswith('PAGE') and _is_numbered_label(label, 'PAGE'):
+            self.page_metadata_labels.append(label)
 
     def dump(self):
         print('# NotebookBuilder Dump:')
-        print(f'# total_size = {self.total_size}')
+        print(f'# total_size = {self.get_total_size()}')
         print(f'# toc = {self.toc}')
 
 
@@ -92,8 +104,9 @@ def reconstruct(notebook):
     _pack_cover(builder, notebook)
     _pack_keywords(builder, notebook)
     _pack_titles(builder, notebook)
-    _pack_backgrounds(builder, notebook)
-    _pack_pages(builder, notebook)
+    pages = _wrap_pages(notebook)
+    _pack_backgrounds(builder, pages)
+    _pack_pages(builder, pages)
     _pack_footer(builder)
     _pack_footer_address(builder)
     reconstructed_binary = builder.build()
@@ -116,7 +129,8 @@ def merge(notebook1, notebook2):
         raise ValueError(f'Only latest file format version is supported ({metadata1.signature} != {expected_signature})')
     if metadata1.signature != metadata2.signature:
         raise ValueError(f'File signature must be same between merging files ({metadata1.signature} != {metadata2.signature})')
-    if notebook1.get_total_pages() + notebook2.get_total_pages() > 9999:
+    offset = notebook1.get_total_pages()
+    if offset + notebook2.get_total_pages() > 9999:
         raise ValueError('The total number of pages are limited to 9999')
     # check header properties are same to avoid generating a corrupted note file
     _verify_header_property('FILE_TYPE', metadata1, metadata2)
@@ -132,13 +146,15 @@ def merge(notebook1, notebook2):
     _pack_header(builder, notebook1)
     _pack_cover(builder, notebook1)
     _pack_keywords(builder, notebook1)
-    _pack_keywords(builder, notebook2, offset=notebook1.get_total_pages())
+    _pack_keywords(builder, notebook2, offset=offset)
     _pack_titles(builder, notebook1)
-    _pack_titles(builder, notebook2, offset=notebook1.get_total_pages())
-    _pack_backgrounds(builder, notebook1)
-    _pack_backgrounds(builder, notebook2)
-    _pack_pages(builder, notebook1)
-    _pack_pages(builder, notebook2, offset=notebook1.get_total_pages())
+    _pack_titles(builder, notebook2, offset=offset)
+    pages1 = _wrap_pages(notebook1)
+    pages2 = _wrap_pages(notebook2)
+    _pack_backgrounds(builder, pages1)
+    _pack_backgrounds(builder, pages2)
+    _pack_pages(builder, pages1)
+    _pack_pages(builder, pages2, offset=offset)
     _pack_footer(builder)
     _pack_footer_address(builder)
     merged_binary = builder.build()
@@ -176,14 +192,10 @@ def _pack_keywords(builder, notebook, offset=0):
         id = f'{page_number:04d}{position:04d}'
         content = keyword.get_content()
         if content is not None:
-            builder.append(f'KEYWORD_{id}', content, allow_duplicate=True)
+            address = builder.append(f'KEYWORD_{id}', content, allow_duplicate=True)
             keyword_metadata = keyword.metadata
             keyword_metadata['KEYWORDPAGE'] = page_number
-            address_list = builder.get_duplicate_block_address_list(f'KEYWORD_{id}')
-            if len(address_list) == 1:
-                keyword_metadata['KEYWORDSITE'] = str(address_list[0])
-            else:
-                keyword_metadata['KEYWORDSITE'] = str(address_list[-1]) # use last address
+            keyword_metadata['KEYWORDSITE'] = str(address)
             keyword_metadata_block = _construct_metadata_block(keyword_metadata)
             builder.append(f'KEYWORD_{id}/metadata', keyword_metadata_block, allow_duplicate=True)
 
@@ -197,46 +209,52 @@ def _pack_titles(builder, notebook, offset=0):
         id = f'{page_number:04d}{position:04d}'
         content = title.get_content()
         if content is not None:
-            builder.append(f'TITLE_{id}', content, allow_duplicate=True)
+            address = builder.append(f'TITLE_{id}', content, allow_duplicate=True)
             title_metadata = title.metadata
-            address_list = builder.get_duplicate_block_address_list(f'TITLE_{id}')
-            if len(address_list) == 1:
-                title_metadata['TITLEBITMAP'] = str(address_list[0])
-            else:
-                title_metadata['TITLEBITMAP'] = str(address_list[-1]) # use last address
+            title_metadata['TITLEBITMAP'] = str(address)
             title_metadata_block = _construct_metadata_block(title_metadata)
             builder.append(f'TITLE_{id}/metadata', title_metadata_block, allow_duplicate=True)
 
-def _pack_backgrounds(builder, notebook):
-    for i in range(notebook.get_total_pages()):
-        page = notebook.get_page(i)
+def _wrap_pages(notebook):
+    """Returns list of (wrapped page, style label) pairs of the notebook.
+
+    Pages are wrapped and their style labels are resolved once here,
+    then shared by `_pack_backgrounds` and `_pack_pages`.
+    """
+    pages = []
+    for page in notebook.pages:
+        page = utils.WorkaroundPageWrapper.from_page(page)
         style = page.get_style()
         if style.startswith('user_'):
             style += page.get_style_hash()
+        pages.append((page, f'STYLE_{style}'))
+    return pages
+
+def _pack_backgrounds(builder, pages):
+    for page, style_label in pages:
+        if style_label in builder.get_labels():
+            # background of this style is already packed
+            continue
         content = _find_background_content_from_page(page)
         if content is not None:
-            builder.append(f'STYLE_{style}', content)
+            builder.append(style_label, content)
 
-def _pack_pages(builder, notebook, offset=0):
-    for i in range(notebook.get_total_pages()):
+def _pack_pages(builder, pages, offset=0):
+    for i, (page, style_label) in enumerate(pages):
         page_number = i + 1 + offset
-        page = notebook.get_page(i)
-        page = utils.WorkaroundPageWrapper.from_page(page)
         # layers
+        layer_metadata_addresses = {}
         layers = page.get_layers()
         for layer in layers:
             layer_name = layer.get_name()
             if layer_name is None:
                 continue
             if layer_name == 'BGLAYER':
-                style = page.get_style()
-                if style.startswith('user_'):
-                    style += page.get_style_hash()
                 layer_metadata = layer.metadata
                 layer_metadata['LAYERNAME'] = layer_name
-                layer_metadata['LAYERBITMAP'] = str(builder.get_block_address(f'STYLE_{style}'))
+                layer_metadata['LAYERBITMAP'] = str(builder.get_block_address(style_label))
                 layer_metadata_block = _construct_metadata_block(layer_metadata)
-                builder.append(f'PAGE{page_number}/{layer_name}/metadata', layer_metadata_block)
+                address = builder.append(f'PAGE{page_number}/{layer_name}/metadata', layer_metadata_block)
             else:
                 content = layer.get_content()
                 builder.append(f'PAGE{page_number}/{layer_name}/LAYERBITMAP', content)
@@ -244,77 +262,69 @@ def _pack_pages(builder, notebook, offset=0):
                 layer_metadata['LAYERNAME'] = layer_name
                 layer_metadata['LAYERBITMAP'] = str(builder.get_block_address(f'PAGE{page_number}/{layer_name}/LAYERBITMAP'))
                 layer_metadata_block = _construct_metadata_block(layer_metadata)
-                builder.append(f'PAGE{page_number}/{layer_name}/metadata', layer_metadata_block)
+                address = builder.append(f'PAGE{page_number}/{layer_name}/metadata', layer_metadata_block)
+            if address is not None:
+                layer_metadata_addresses[layer_name] = address
         # totalpath
+        totalpath_address = 0
         totalpath_block = page.get_totalpath()
         if totalpath_block is not None:
-            builder.append(f'PAGE{page_number}/TOTALPATH', totalpath_block)
+            totalpath_address = builder.append(f'PAGE{page_number}/TOTALPATH', totalpath_block)
         # page metadata
         page_metadata = page.metadata
         del page_metadata['__layers__']
         for prop in ['MAINLAYER', 'LAYER1', 'LAYER2', 'LAYER3', 'BGLAYER']:
-            address = builder.get_block_address(f'PAGE{page_number}/{prop}/metadata')
-            page_metadata[prop] = address
-        page_metadata['TOTALPATH'] = builder.get_block_address(f'PAGE{page_number}/TOTALPATH')
+            page_metadata[prop] = layer_metadata_addresses.get(prop, 0)
+        page_metadata['TOTALPATH'] = totalpath_address
         page_metadata_block = _construct_metadata_block(page_metadata)
         builder.append(f'PAGE{page_number}/metadata', page_metadata_block)
 
 def _pack_footer(builder):
     metadata_footer = {}
-    metadata_footer.setdefault('FILE_FEATURE', builder.get_block_address('__header__'))
+    metadata_footer['FILE_FEATURE'] = builder.get_block_address('__header__')
     address = builder.get_block_address('COVER_1')
     if address == 0:
         metadata_footer['COVER_0'] = 0
     else:
         metadata_footer['COVER_1'] = address
-    for label in builder.get_labels():
-        if re.match(r'KEYWORD_\d{8}/metadata', label):
-            address_list = builder.get_duplicate_block_address_list(label)
-            label = label[:-len('/metadata')]
-            if len(address_list) == 1:
-                metadata_footer.setdefault(label, address_list[0])
-            else:
-                metadata_footer[label] = address_list
-    for label in builder.get_labels():
-        if re.match(r'TITLE_\d{8}/metadata', label):
-            address_list = builder.get_duplicate_block_address_list(label)
-            label = label[:-len('/metadata')]
-            if len(address_list) == 1:
-                metadata_footer.setdefault(label, address_list[0])
-            else:
-                metadata_footer[label] = address_list
-    for label in builder.get_labels():
-        if label.startswith('STYLE_'):
-            address = builder.get_block_address(label)
-            metadata_footer.setdefault(label, address)
-    for label in builder.get_labels():
-        if re.match(r'PAGE\d+/metadata', label):
-            address = builder.get_block_address(label)
-            label = label[:-len('/metadata')]
-            metadata_footer.setdefault(label, address)
+    toc = builder.toc
+    for label in itertools.chain(builder.keyword_metadata_labels, builder.title_metadata_labels):
+        address_list = toc[label]
+        label = label[:-len('/metadata')]
+        if len(address_list) == 1:
+            metadata_footer[label] = address_list[0]
+        else:
+            metadata_footer[label] = address_list
+    for label in builder.style_labels:
+        metadata_footer[label] = toc[label][0]
+    for label in builder.page_metadata_labels:
+        metadata_footer[label[:-len('/metadata')]] = toc[label][0]
     footer_block = _construct_metadata_block(metadata_footer)
     builder.append('__footer__', footer_block)
 
 def _pack_footer_address(builder):
     footer_address = builder.get_block_address('__footer__')
-    builder.append('__footer_address__', footer_address.to_bytes(4, 'little'), skip_block_size=True)
+    builder.append('__footer_address__', _UINT32.pack(footer_address), skip_block_size=True)
 
 def _verify_header_property(prop_name, metadata1, metadata2):
     if metadata1.header.get(prop_name) != metadata2.header.get(prop_name):
         raise ValueError(f'<{prop_name}> property must be same between merging files')
 
 def _construct_metadata_block(info):
-    block_data = ''
+    block_data = []
     for k, v in info.items():
-        if type(v) == list:
-            for e in v:
-                block_data += f'<{k}:{e}>'
+        if isinstance(v, list):
+            block_data.extend(f'<{k}:{e}>' for e in v)
         else:
-            block_data += f'<{k}:{v}>'
-    return block_data.encode('utf-8')
+            block_data.append(f'<{k}:{v}>')
+    return ''.join(block_data).encode('utf-8')
+
+def _is_numbered_label(label, prefix, digits=None):
+    """Returns True if label is formatted as `<prefix><number>/metadata`."""
+    number = label[len(prefix):-len('/metadata')]
+    return number.isdecimal() and (digits is None or len(number) == digits)
 
 def _find_background_content_from_page(page):
-    page = utils.WorkaroundPageWrapper.from_page(page)
     if not page.is_layer_supported():
         return None
     layers = page.get_layers()
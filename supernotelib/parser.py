@@ -14,12 +14,35 @@
 
 """Parser classes."""
 
+# Note on performance: parsing is dominated by str/dict/bytes handling and
+# file I/O, which JIT compilers such as Numba cannot accelerate in nopython
+# mode. Prefer reducing I/O (memory-mapped reads, reading blocks in file
+# order) and precompiled regex patterns instead.
+
+import contextlib
+import errno
+import mmap
 import os
 import re
+from enum import IntFlag
 
 from . import exceptions
 from . import fileformat
 
+_PARAMETER_PATTERN = re.compile(r'<([^:<>]+):([^:<>]*)>')
+
+
+class Sections(IntFlag):
+    """Sections of a notebook whose contents are read by `load`."""
+    PAGES = 0x01        # page and layer bitmaps
+    COVER = 0x02
+    KEYWORDS = 0x04
+    TITLES = 0x08
+    LINKS = 0x10
+    TOTALPATH = 0x20
+    RECOGN = 0x40       # recognition file and text
+    ALL = 0x7f
+
 
 def parse_metadata(stream, policy='strict'):
     """Parses a supernote binary stream and returns metadata object.
@@ -40,28 +63,26 @@ def parse_metadata(stream, policy='strict'):
     SupernoteMetadata
         metadata object
     """
-    try:
-        parser = SupernoteXParser()
-        metadata = parser.parse_stream(stream, policy)
-    except exceptions.UnsupportedFileFormat:
-        # ignore this exception and try next parser
-        pass
-    else:
-        return metadata
-
-    try:
-        parser = SupernoteParser()
-        metadata = parser.parse_stream(stream, policy)
-    except exceptions.UnsupportedFileFormat:
-        # ignore this exception and try next parser
-        pass
-    else:
-        return metadata
+    parsers = [SupernoteXParser(), SupernoteParser()]
+    # dispatch by known signature first, so that the stream is parsed once
+    for parser in parsers:
+        if parser._find_matching_signature(stream) is not None:
+            return parser.parse_stream(stream, policy)
+
+    if policy == 'loose':
+        # unknown signature, try every parser for a compatible one
+        for parser in parsers:
+            try:
+                metadata = parser.parse_stream(stream, policy)
+            except exceptions.UnsupportedFileFormat:
+                # ignore this exception and try next parser
+                continue
+            return metadata
 
     # we cannot parse the file with any our parser.
     raise exceptions.UnsupportedFileFormat('unsupported file format')
 
-def load(stream, metadata=None, policy='strict'):
+def load(stream, metadata=None, policy='strict', sections=Sections.ALL):
     """Creates a Notebook object from the supernote binary stream.
 
     Policy:
@@ -76,6 +97,8 @@ def load(stream, metadata=None, policy='strict'):
         metadata object
     policy : str
         signature check policy
+    sections : Sections
+        sections whose contents are read, other contents are left None
 
     Returns
     -------
@@ -87,57 +110,63 @@ def load(stream, metadata=None, policy='strict'):
 
     note = fileformat.Notebook(metadata)
 
+    # collect (address, setter) pairs first and read blocks in file order,
+    # so that the stream is scanned forward instead of seeking back and forth
+    blocks = []
     cover_address = _get_cover_address(metadata)
-    if cover_address > 0:
-        content = _get_content_at_address(stream, cover_address)
-        note.get_cover().set_content(content)
+    if cover_address > 0 and sections & Sections.COVER:
+        blocks.append((cover_address, note.get_cover().set_content))
     # store keyword data to notebook object
-    for keyword in note.get_keywords():
-        address = _get_keyword_address(keyword)
-        content = _get_content_at_address(stream, address)
-        keyword.set_content(content)
+    if sections & Sections.KEYWORDS:
+        for keyword in note.get_keywords():
+            blocks.append((_get_keyword_address(keyword), keyword.set_content))
     # store title data to notebook object
     page_numbers = _get_page_number_from_footer_property(note.get_metadata().footer, 'TITLE_')
     for i, title in enumerate(note.get_titles()):
-        address = _get_title_address(title)
-        content = _get_content_at_address(stream, address)
-        title.set_content(content)
+        if sections & Sections.TITLES:
+            blocks.append((_get_title_address(title), title.set_content))
         title.set_page_number(page_numbers[i])
     # store link data to notebook object
     page_numbers = _get_page_number_from_footer_property(note.get_metadata().footer, 'LINK')
     for i, link in enumerate(note.get_links()):
-        address = _get_link_address(link)
-        content = _get_content_at_address(stream, address)
-        link.set_content(content)
+        if sections & Sections.LINKS:
+            blocks.append((_get_link_address(link), link.set_content))
         link.set_page_number(page_numbers[i])
-    page_total = metadata.get_total_pages()
-    for p in range(page_total):
-        addresses = _get_bitmap_address(metadata, p)
-        if len(addresses) == 1: # the page has no layers
-            content = _get_content_at_address(stream, addresses[0])
-            note.get_page(p).set_content(content)
-        else:
-            for l, addr in enumerate(addresses):
-                content = _get_content_at_address(stream, addr)
-                note.get_page(p).get_layer(l).set_content(content)
+    for p, page_info in enumerate(metadata.pages):
+        page = note.get_page(p)
+        if sections & Sections.PAGES:
+            addresses = _get_bitmap_address(metadata, p)
+            if len(addresses) == 1: # the page has no layers
+                blocks.append((addresses[0], page.set_content))
+            else:
+                for l, addr in enumerate(addresses):
+                    blocks.append((addr, page.get_layer(l).set_content))
         # store path data to notebook object
-        totalpath_address = _get_totalpath_address(metadata, p)
-        if totalpath_address > 0:
-            content = _get_content_at_address(stream, totalpath_address)
-            note.get_page(p).set_totalpath(content)
-        # store recogn file data to notebook object
-        recogn_file_address = _get_recogn_file_address(metadata, p)
-        if recogn_file_address > 0:
-            content = _get_content_at_address(stream, recogn_file_address)
-            note.get_page(p).set_recogn_file(content)
-        # store recogn text data to notebook object
-        recogn_text_address = _get_recogn_text_address(metadata, p)
-        if recogn_text_address > 0:
-            content = _get_content_at_address(stream, recogn_text_address)
-            note.get_page(p).set_recogn_text(content)
+        if sections & Sections.TOTALPATH:
+            totalpath_address = _get_totalpath_address(page_info)
+            if totalpath_address > 0:
+                blocks.append((totalpath_address, page.set_totalpath))
+        if sections & Sections.RECOGN:
+            # store recogn file data to notebook object
+            recogn_file_address = _get_recogn_file_address(page_info)
+            if recogn_file_address > 0:
+                blocks.append((recogn_file_address, page.set_recogn_file))
+            # store recogn text data to notebook object
+            recogn_text_address = _get_recogn_text_address(page_info)
+            if recogn_text_address > 0:
+                blocks.append((recogn_text_address, page.set_recogn_text))
+    blocks.sort(key=lambda block: block[0])
+    last_address = None
+    for address, set_content in blocks:
+        # blocks shared by several entries are adjacent after sorting,
+        # so they are read only once
+        if address != last_address:
+            content = _get_content_at_address(stream, address)
+            last_address = address
+        set_content(content)
     return note
 
-def load_notebook(file_name, metadata=None, policy='strict'):
+def load_notebook(file_name, metadata=None, policy='strict', sections=Sections.ALL):
     """Creates a Notebook object from the supernote file.
 
     Policy:
@@ -152,16 +181,74 @@ def load_notebook(file_name, metadata=None, policy='strict'):
         metadata object
     policy : str
         signature check policy
+    sections : Sections
+        sections whose contents are read, other contents are left None
 
     Returns
     -------
     Notebook
         notebook object
     """
-    with open(file_name, 'rb') as f:
-        note = load(f, metadata, policy)
+    with open(file_name, 'rb') as f, _map_file(f) as stream:
+        note = load(stream, metadata, policy, sections)
     return note
 
+@contextlib.contextmanager
+def _map_file(fobj):
+    """Yields a read-only memory-mapped view of the file.
+
+    The view supports the same seek/read interface as the file, but
+    serves reads without a system call each. Falls back to the file
+    object itself if it cannot be mapped (e.g. empty file).
+    """
+    try:
+        mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        mm = None
+    if mm is None:
+        yield fobj
+        return
+    with mm:
+        yield _MappedFile(mm)
+
+
+class _MappedFile:
+    """Read-only file-like view of a memory map.
+
+    Unlike `mmap.seek`, seeking past the end is allowed and the next read
+    returns short data, as with a regular file. This keeps block addresses
+    pointing past the end of a corrupt note from failing differently than
+    they do on a regular file or `io.BytesIO`.
+    """
+    __slots__ = ('_mm', '_pos')
+
+    def __init__(self, mm):
+        self._mm = mm
+        self._pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._mm)
+        if offset < 0:
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        pos = self._pos
+        if size is None or size < 0:
+            data = self._mm[pos:]
+        else:
+            data = self._mm[pos:pos + size]
+        self._pos = pos + len(data)
+        return data
+
+
 def _get_content_at_address(fobj, address):
     content = None
     if address != 0:
@@ -222,67 +309,67 @@ def _get_bitmap_address(metadata, page_number):
     list of int
         bitmap address
     """
-    addresses = []
-    layer_supported = metadata.is_layer_supported(page_number)
-    if layer_supported:
-        for l in range(5):      # TODO: use constant
-            address = metadata.pages[page_number][fileformat.KEY_LAYERS][l].get('LAYERBITMAP')
-            addresses.append(0 if address is None else int(address))
-    else:
-        addresses.append(int(metadata.pages[page_number]['DATA']))
-    return addresses
+    page = metadata.pages[page_number]
+    if metadata.is_layer_supported(page_number):
+        layers = page[fileformat.KEY_LAYERS]
+        return [int(layers[l].get('LAYERBITMAP', 0)) for l in range(5)] # TODO: use constant
+    return [int(page['DATA'])]
+
+def _get_totalpath_address(page_info):
+    """Returns total path address of the given page.
 
-def _get_totalpath_address(metadata, page_number):
-    """Returns total path address of the given page number.
+    Parameters
+    ----------
+    page_info : dict
+        page parameters
 
     Returns
     -------
     int
         total path address
     """
-    if 'TOTALPATH' in metadata.pages[page_number]:
-        address = int(metadata.pages[page_number]['TOTALPATH'])
-    else:
-        address = 0
-    return address
+    return int(page_info.get('TOTALPATH', 0))
+
+def _get_recogn_file_address(page_info):
+    """Returns recogn file address of the given page.
 
-def _get_recogn_file_address(metadata, page_number):
-    """Returns recogn file address of the given page number.
+    Parameters
+    ----------
+    page_info : dict
+        page parameters
 
     Returns
     -------
     int
         recogn file address
     """
-    if 'RECOGNFILE' in metadata.pages[page_number]:
-        address = int(metadata.pages[page_number]['RECOGNFILE'])
-    else:
-        address = 0
-    return address
+    return int(page_info.get('RECOGNFILE', 0))
+
+def _get_recogn_text_address(page_info):
+    """Returns recogn text address of the given page.
 
-def _get_recogn_text_address(metadata, page_number):
-    """Returns recogn text address of the given page number.
+    Parameters
+    ----------
+    page_info : dict
+        page parameters
 
     Returns
     -------
     int
         recogn text address
     """
-    if 'RECOGNTEXT' in metadata.pages[page_number]:
-        address = int(metadata.pages[page_number]['RECOGNTEXT'])
-    else:
-        address = 0
-    return address
+    return int(page_info.get('RECOGNTEXT', 0))
 
 def _get_page_number_from_footer_property(footer, prefix):
-    keys = filter(lambda k : k.startswith(prefix), footer.keys())
     page_numbers = []
-    for k in keys:
-        if type(footer[k]) == list:
-            for _ in range(len(footer[k])):
-                page_numbers.append(int(k[6:10]) - 1)
+    for k, v in footer.items():
+        if not k.startswith(prefix):
+            continue
+        page_number = int(k[6:10]) - 1 # e.g. get '0123' from 'TITLE_01234567'
+        if isinstance(v, list):
+            page_numbers.extend([page_number] * len(v))
         else:
-            page_numbers.append(int(k[6:10]) - 1) # e.g. get '0123' from 'TITLE_01234567'
+            page_numbers.append(page_number)
     return page_numbers
 
 
@@ -290,6 +377,7 @@ class SupernoteParser:
     """Parser for original Supernote."""
     SN_SIGNATURE_OFFSET = 0
     SN_SIGNATURE_PATTERN = r'SN_FILE_ASA_\d{8}'
+    _SIGNATURE_RE = re.compile(SN_SIGNATURE_PATTERN)
     SN_SIGNATURES = ['SN_FILE_ASA_20190529']
 
     def parse(self, file_name, policy='strict'):
@@ -311,8 +399,8 @@ class SupernoteParser:
         SupernoteMetadata
             metadata of the file
         """
-        with open(file_name, 'rb') as f:
-            metadata = self.parse_stream(f, policy)
+        with open(file_name, 'rb') as f, _map_file(f) as stream:
+            metadata = self.parse_stream(stream, policy)
         return metadata
 
     def parse_stream(self, stream, policy='strict'):
@@ -381,15 +469,12 @@ class SupernoteParser:
         string
             matching signature or None if not found
         """
+        # read once and compare as bytes, so that no decode is needed
+        fobj.seek(self.SN_SIGNATURE_OFFSET, os.SEEK_SET)
+        head = fobj.read(max(map(len, self.SN_SIGNATURES)))
         for sig in self.SN_SIGNATURES:
-            try:
-                fobj.seek(self.SN_SIGNATURE_OFFSET, os.SEEK_SET)
-                signature = fobj.read(len(sig)).decode()
-            except UnicodeDecodeError:
-                # try next signature
-                continue
-            if signature == sig:
-                return signature
+            if head.startswith(sig.encode()):
+                return sig
         return None
 
     def _check_signature_compatible(self, fobj):
@@ -400,7 +485,7 @@ class SupernoteParser:
         except Exception:
             return False
         else:
-            if re.match(self.SN_SIGNATURE_PATTERN, signature):
+            if self._SIGNATURE_RE.match(signature):
                 return True
             else:
                 return False
@@ -437,7 +522,7 @@ class SupernoteParser:
         list of int
             list of page address
         """
-        if type(footer.get('PAGE')) == list:
+        if isinstance(footer.get('PAGE'), list):
             page_addresses = list(map(lambda a: int(a), footer.get('PAGE')))
         else:
             page_addresses = [int(footer.get('PAGE'))]
@@ -501,25 +586,20 @@ class SupernoteParser:
         dict
             extracted parameters
         """
-        pattern = r'<([^:<>]+):([^:<>]*)>'
-        result = re.finditer(pattern, metadata)
         params = {}
-        for m in result:
-            key = m[1]
-            value = m[2]
-            if params.get(key):
+        for key, value in _PARAMETER_PATTERN.findall(metadata):
+            existing = params.get(key)
+            if not existing:
+                params[key] = value
+            elif not isinstance(existing, list):
                 # the key is duplicate.
-                if type(params.get(key)) != list:
-                    # To store duplicate parameters, we transform data structure
-                    # from {key: value} to {key: [value1, value2, ...]}
-                    first_value = params.pop(key)
-                    params[key] = [first_value, value]
-                else:
-                    # Data structure have already been transformed.
-                    # We simply append new value to the list.
-                    params[key].append(value)
+                # To store duplicate parameters, we transform data structure
+                # from {key: value} to {key: [value1, value2, ...]}
+                params[key] = [existing, value]
             else:
-                params[key] = value
+                # Data structure have already been transformed.
+                # We simply append new value to the list.
+                existing.append(value)
         return params
 
 
@@ -527,6 +607,7 @@ class SupernoteXParser(SupernoteParser):
     """Parser for Supernote X-series."""
     SN_SIGNATURE_OFFSET = 4
     SN_SIGNATURE_PATTERN = r'SN_FILE_VER_\d{8}'
+    _SIGNATURE_RE = re.compile(SN_SIGNATURE_PATTERN)
     SN_SIGNATURES = [
         'SN_FILE_VER_20200001', # Firmware version C.053
         'SN_FILE_VER_20200005', # Firmware version C.077
@@ -562,39 +643,42 @@ class SupernoteXParser(SupernoteParser):
         return footer
 
     def _get_keyword_addresses(self, footer):
-        keyword_keys = filter(lambda k : k.startswith('KEYWORD_'), footer.keys())
         keyword_addresses = []
-        for k in keyword_keys:
-            if type(footer[k]) == list:
-                keyword_addresses.extend(list(map(int, footer[k])))
+        for k, v in footer.items():
+            if not k.startswith('KEYWORD_'):
+                continue
+            if isinstance(v, list):
+                keyword_addresses.extend(map(int, v))
             else:
-                keyword_addresses.append(int(footer[k]))
+                keyword_addresses.append(int(v))
         return keyword_addresses
 
     def _parse_keyword_block(self, fobj, address):
         return self._parse_metadata_block(fobj, address)
 
     def _get_title_addresses(self, footer):
-        title_keys = filter(lambda k : k.startswith('TITLE_'), footer.keys())
         title_addresses = []
-        for k in title_keys:
-            if type(footer[k]) == list:
-                title_addresses.extend(list(map(int, footer[k])))
+        for k, v in footer.items():
+            if not k.startswith('TITLE_'):
+                continue
+            if isinstance(v, list):
+                title_addresses.extend(map(int, v))
             else:
-                title_addresses.append(int(footer[k]))
+                title_addresses.append(int(v))
         return title_addresses
 
     def _parse_title_block(self, fobj, address):
         return self._parse_metadata_block(fobj, address)
 
     def _get_link_addresses(self, footer):
-        link_keys = filter(lambda k : k.startswith('LINK'), footer.keys())
         link_addresses = []
-        for k in link_keys:
-            if type(footer[k]) == list:
-                link_addresses.extend(list(map(int, footer[k])))
+        for k, v in footer.items():
+            if not k.startswith('LINK'):
+                continue
+            if isinstance(v, list):
+                link_addresses.extend(map(int, v))
             else:
-                link_addresses.append(int(footer[k]))
+                link_addresses.append(int(v))
         return link_addresses
 
     def _parse_link_block(self, fobj, address):
@@ -613,9 +697,7 @@ class SupernoteXParser(SupernoteParser):
         list of int
             list of page address
         """
-        page_keys = filter(lambda k : k.startswith('PAGE'), footer.keys())
-        page_addresses = list(map(lambda k: int(footer[k]), page_keys))
-        return page_addresses
+        return [int(v) for k, v in footer.items() if k.startswith('PAGE')]
 
     def _parse_page_block(self, fobj, address):
         """Returns parameters in a page block.
@@ -634,8 +716,7 @@ class SupernoteXParser(SupernoteParser):
         """
         page_info = super()._parse_page_block(fobj, address)
         layer_addresses = self._get_layer_addresses(page_info)
-        layers = list(map(lambda addr: self._parse_layer_block(fobj, addr), layer_addresses))
-        page_info[fileformat.KEY_LAYERS] = layers
+        page_info[fileformat.KEY_LAYERS] = [self._parse_layer_block(fobj, addr) for addr in layer_addresses]
         return page_info
 
     def _get_layer_addresses(self, page_info):
@@ -651,9 +732,9 @@ class SupernoteXParser(SupernoteParser):
         list of int
             list of layer address
         """
-        layer_keys = filter(lambda k : k in self.LAYER_KEYS, page_info)
-        layer_addresses = list(map(lambda k: int(page_info[k]), layer_keys))
-        return layer_addresses
+        # follow LAYER_KEYS order, not the order of keys in the page block,
+        # so that layer indices do not depend on how the firmware wrote them
+        return [int(page_info[k]) for k in self.LAYER_KEYS if k in page_info]
 
     def _parse_layer_block(self, fobj, address):
         """Returns parameters in a layer block.
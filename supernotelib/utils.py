@@ -24,6 +24,9 @@ class WorkaroundPageWrapper(fileformat.Page):
 
     @staticmethod
     def from_page(page):
+        if isinstance(page, WorkaroundPageWrapper):
+            # layer names are already fixed up
+            return page
         wrapped_page = WorkaroundPageWrapper(page.metadata)
         # copy contents from the original page object
         wrapped_page.set_content(page.get_content())